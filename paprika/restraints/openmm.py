@@ -1,12 +1,26 @@
 """A module aimed at applying restraints directly to OpenMM systems."""
 import logging
+import os
+from functools import lru_cache
 
 import numpy as np
 import parmed as pmd
+from simtk import openmm, unit
 
 logger = logging.getLogger(__name__)
 _PI_ = np.pi
 
+# Conversion factors from the units used by pAPRika restraints to the OpenMM MD
+# unit system, so that force parameters can be passed to OpenMM as plain floats.
+_ANGSTROM = unit.angstrom.conversion_factor_to(unit.nanometer)
+_DEGREE = unit.degree.conversion_factor_to(unit.radian)
+_KCAL_PER_MOL_PER_A2 = (
+    unit.kilocalories_per_mole / unit.angstrom ** 2
+).conversion_factor_to(unit.kilojoules_per_mole / unit.nanometer ** 2)
+_KCAL_PER_MOL_PER_RAD2 = (
+    unit.kilocalories_per_mole / unit.radian ** 2
+).conversion_factor_to(unit.kilojoules_per_mole / unit.radian ** 2)
+
 
 def apply_positional_restraints(coordinate_path: str, system, force_group: int = 15):
     """A utility function which will add OpenMM harmonic positional restraints to
@@ -25,35 +39,49 @@ def apply_positional_restraints(coordinate_path: str, system, force_group: int =
         The force group to add the positional restraints to.
     """
 
-    from simtk import openmm, unit
+    dummy_indices, dummy_positions = _load_dummy_atoms(
+        coordinate_path, os.path.getmtime(coordinate_path)
+    )
 
-    # noinspection PyTypeChecker
-    structure: pmd.Structure = pmd.load_file(coordinate_path, structure=True)
+    if len(dummy_indices) == 0:
+        return
 
-    for atom in structure.atoms:
+    # All of the dummy atoms share the same functional form, so a single force
+    # with one particle per dummy atom is used rather than one force per atom.
+    positional_restraint = openmm.CustomExternalForce(
+        "k * ((x-x0)^2 + (y-y0)^2 + (z-z0)^2)"
+    )
+    positional_restraint.addPerParticleParameter("k")
+    positional_restraint.addPerParticleParameter("x0")
+    positional_restraint.addPerParticleParameter("y0")
+    positional_restraint.addPerParticleParameter("z0")
 
-        if atom.name == "DUM":
-            positional_restraint = openmm.CustomExternalForce(
-                "k * ((x-x0)^2 + (y-y0)^2 + (z-z0)^2)"
-            )
-            positional_restraint.addPerParticleParameter("k")
-            positional_restraint.addPerParticleParameter("x0")
-            positional_restraint.addPerParticleParameter("y0")
-            positional_restraint.addPerParticleParameter("z0")
+    k = 50.0 * _KCAL_PER_MOL_PER_A2
+
+    for index, (x0, y0, z0) in zip(dummy_indices, dummy_positions):
+        positional_restraint.addParticle(int(index), [k, x0, y0, z0])
+
+    system.addForce(positional_restraint)
+    positional_restraint.setForceGroup(force_group)
+
+
+@lru_cache(maxsize=32)
+def _load_dummy_atoms(coordinate_path, modification_time):
+    """Return the indices and positions (in nanometers) of the dummy atoms in a
+    coordinate file. The result is cached, using the file modification time as
+    part of the key, so that the same file is only parsed once."""
 
-            # I haven't found a way to get this to use ParmEd's unit library here.
-            # ParmEd correctly reports `atom.positions` as units of Ångstroms.
-            # But then we can't access atom indices. Using `atom.xx` works for
-            # coordinates, but is unitless.
-            k = 50.0 * unit.kilocalories_per_mole / unit.angstroms ** 2
+    # noinspection PyTypeChecker
+    structure: pmd.Structure = pmd.load_file(coordinate_path, structure=True)
 
-            x0 = 0.1 * atom.xx * unit.nanometers
-            y0 = 0.1 * atom.xy * unit.nanometers
-            z0 = 0.1 * atom.xz * unit.nanometers
+    # Only the dummy atoms are restrained, so select them with a mask over the
+    # atom names and slice the (unitless, Ångstrom) coordinate array directly
+    # instead of reading positions from every `Atom` object.
+    atom_names = np.array([atom.name for atom in structure.atoms], dtype=str)
+    dummy_indices = np.flatnonzero(np.char.equal(atom_names, "DUM"))
+    dummy_positions = np.asarray(structure.coordinates)[dummy_indices] * _ANGSTROM
 
-            positional_restraint.addParticle(atom.idx, [k, x0, y0, z0])
-            system.addForce(positional_restraint)
-            positional_restraint.setForceGroup(force_group)
+    return dummy_indices, dummy_positions
 
 
 def apply_dat_restraint(
@@ -62,12 +90,16 @@ def apply_dat_restraint(
     """A utility function which takes in pAPRika restraints and applies the
     restraints to an OpenMM System object.
 
+    .. note ::
+        To apply a list of restraints, use :func:`apply_dat_restraints` instead,
+        which shares one OpenMM force between restraints of the same type.
+
     Parameters
     ----------
     system : :class:`openmm.System`
         The system object to add the positional restraints to.
-    restraint : list
-        List of pAPRika defined restraints
+    restraint : :class:`paprika.restraints.DAT_restraint`
+        The pAPRika defined restraint
     phase : str
         Phase of calculation ("attach", "pull" or "release")
     window_number : int
@@ -78,12 +110,92 @@ def apply_dat_restraint(
         The force group to add the positional restraints to.
 
     """
+    apply_dat_restraints(
+        system,
+        [restraint],
+        phase,
+        window_number,
+        flat_bottom=flat_bottom,
+        force_group=force_group,
+    )
+
+
+def apply_dat_restraints(
+    system, restraints, phase, window_number, flat_bottom=False, force_group=None
+):
+    """A utility function which takes in a list of pAPRika restraints and applies
+    the restraints to an OpenMM System object.
 
-    from simtk import openmm, unit
+    The restraints are grouped by type and a single OpenMM force is created for
+    each type (bond, centroid bond, angle, torsion, flat-bottom bond and
+    flat-bottom angle), instead of one force per restraint.
+
+    Parameters
+    ----------
+    system : :class:`openmm.System`
+        The system object to add the positional restraints to.
+    restraints : list
+        List of pAPRika defined restraints
+    phase : str
+        Phase of calculation ("attach", "pull" or "release")
+    window_number : int
+        The corresponding window number of the current phase
+    flat_bottom : bool, optional
+        Specify whether the restraints are flat bottom potentials
+    force_group : int, optional
+        The force group to add the positional restraints to.
+
+    """
 
     assert phase in {"attach", "pull", "release"}
 
-    if flat_bottom and phase == "attach" and restraint.mask3:
+    # Flat-bottom restraints are only applied during the attach phase.
+    if flat_bottom and phase in {"pull", "release"}:
+        return
+
+    # Sort the restraints by the OpenMM force they will be added to.
+    flat_bottom_angles = []
+    flat_bottom_bonds = []
+    bonds = []
+    centroid_bonds = []
+    angles = []
+    torsions = []
+
+    for restraint in restraints:
+        if flat_bottom and restraint.mask3:
+            flat_bottom_angles.append(restraint)
+
+        elif flat_bottom and not restraint.mask3:
+            flat_bottom_bonds.append(restraint)
+
+        elif restraint.mask2 and not restraint.mask3:
+            if not restraint.group1 and not restraint.group2:
+                bonds.append(restraint)
+            else:
+                centroid_bonds.append(restraint)
+
+        elif restraint.mask3 and not restraint.mask4:
+            if not restraint.group1 and not restraint.group2 and not restraint.group3:
+                angles.append(restraint)
+            else:
+                # Probably needs openmm.CustomCentroidAngleForce (?)
+                raise NotImplementedError
+
+        elif restraint.mask4:
+            if (
+                not restraint.group1
+                and not restraint.group2
+                and not restraint.group3
+                and not restraint.group4
+            ):
+                torsions.append(restraint)
+            else:
+                # Probably needs openmm.CustomCentroidTorsionForce (?)
+                raise NotImplementedError
+
+    forces = []
+
+    if flat_bottom_angles:
         flat_bottom_force = openmm.CustomAngleForce(
             "step(-(theta - theta_0)) * k * (theta - theta_0)^2"
         )
@@ -92,132 +204,95 @@ def apply_dat_restraint(
         flat_bottom_force.addPerAngleParameter("k")
         flat_bottom_force.addPerAngleParameter("theta_0")
 
-        theta_0 = 91.0 * unit.degrees
-        k = (
-            restraint.phase[phase]["force_constants"][window_number]
-            * unit.kilocalories_per_mole
-            / unit.radian ** 2
-        )
-        flat_bottom_force.addAngle(
-            restraint.index1[0],
-            restraint.index2[0],
-            restraint.index3[0],
-            [k, theta_0],
-        )
-        system.addForce(flat_bottom_force)
-        if force_group:
-            flat_bottom_force.setForceGroup(force_group)
-
-        return
+        theta_0 = 91.0 * _DEGREE
+        for restraint in flat_bottom_angles:
+            _, force_constant = _get_window_values(restraint, phase, window_number)
+            k = force_constant * _KCAL_PER_MOL_PER_RAD2
+            flat_bottom_force.addAngle(
+                restraint.index1[0],
+                restraint.index2[0],
+                restraint.index3[0],
+                [k, theta_0],
+            )
+        forces.append(flat_bottom_force)
 
-    elif flat_bottom and phase == "attach" and not restraint.mask3:
+    if flat_bottom_bonds:
         flat_bottom_force = openmm.CustomBondForce("step((r - r_0)) * k * (r - r_0)^2")
         # If x is greater than x_0, then the argument to step is positive, which means
         # the force is on.
         flat_bottom_force.addPerBondParameter("k")
         flat_bottom_force.addPerBondParameter("r_0")
 
-        r_0 = restraint.phase[phase]["targets"][window_number] * unit.angstrom
-        k = (
-            restraint.phase[phase]["force_constants"][window_number]
-            * unit.kilocalories_per_mole
-            / unit.radian ** 2
-        )
-        flat_bottom_force.addBond(
-            restraint.index1[0],
-            restraint.index2[0],
-            [k, r_0],
-        )
-        system.addForce(flat_bottom_force)
-        if force_group:
-            flat_bottom_force.setForceGroup(force_group)
-
-        return
+        for restraint in flat_bottom_bonds:
+            target, force_constant = _get_window_values(restraint, phase, window_number)
+            r_0 = target * _ANGSTROM
+            k = force_constant * _KCAL_PER_MOL_PER_RAD2
+            flat_bottom_force.addBond(
+                restraint.index1[0],
+                restraint.index2[0],
+                [k, r_0],
+            )
+        forces.append(flat_bottom_force)
 
-    elif flat_bottom and phase == "pull":
-        return
-    elif flat_bottom and phase == "release":
-        return
+    if bonds:
+        bond_restraint = openmm.CustomBondForce("k * (r - r_0)^2")
+        bond_restraint.addPerBondParameter("k")
+        bond_restraint.addPerBondParameter("r_0")
 
-    if restraint.mask2 and not restraint.mask3:
-        if not restraint.group1 and not restraint.group2:
-            bond_restraint = openmm.CustomBondForce("k * (r - r_0)^2")
-            bond_restraint.addPerBondParameter("k")
-            bond_restraint.addPerBondParameter("r_0")
-
-            r_0 = restraint.phase[phase]["targets"][window_number] * unit.angstroms
-            k = (
-                restraint.phase[phase]["force_constants"][window_number]
-                * unit.kilocalories_per_mole
-                / unit.angstrom ** 2
-            )
+        for restraint in bonds:
+            target, force_constant = _get_window_values(restraint, phase, window_number)
+            r_0 = target * _ANGSTROM
+            k = force_constant * _KCAL_PER_MOL_PER_A2
             bond_restraint.addBond(restraint.index1[0], restraint.index2[0], [k, r_0])
-            system.addForce(bond_restraint)
-        else:
-            bond_restraint = openmm.CustomCentroidBondForce(
-                2, "k * (distance(g1, g2) - r_0)^2"
-            )
-            bond_restraint.addPerBondParameter("k")
-            bond_restraint.addPerBondParameter("r_0")
-            r_0 = restraint.phase[phase]["targets"][window_number] * unit.angstroms
-            k = (
-                restraint.phase[phase]["force_constants"][window_number]
-                * unit.kilocalories_per_mole
-                / unit.angstrom ** 2
-            )
+        forces.append(bond_restraint)
+
+    if centroid_bonds:
+        bond_restraint = openmm.CustomCentroidBondForce(
+            2, "k * (distance(g1, g2) - r_0)^2"
+        )
+        bond_restraint.addPerBondParameter("k")
+        bond_restraint.addPerBondParameter("r_0")
+
+        for restraint in centroid_bonds:
+            target, force_constant = _get_window_values(restraint, phase, window_number)
+            r_0 = target * _ANGSTROM
+            k = force_constant * _KCAL_PER_MOL_PER_A2
             g1 = bond_restraint.addGroup(restraint.index1)
             g2 = bond_restraint.addGroup(restraint.index2)
             bond_restraint.addBond([g1, g2], [k, r_0])
-            system.addForce(bond_restraint)
+        forces.append(bond_restraint)
 
-        if force_group:
-            bond_restraint.setForceGroup(force_group)
-
-    elif restraint.mask3 and not restraint.mask4:
-        if not restraint.group1 and not restraint.group2 and not restraint.group3:
-            angle_restraint = openmm.CustomAngleForce("k * (theta - theta_0)^2")
-            angle_restraint.addPerAngleParameter("k")
-            angle_restraint.addPerAngleParameter("theta_0")
-
-            theta_0 = restraint.phase[phase]["targets"][window_number] * unit.degrees
-            k = (
-                restraint.phase[phase]["force_constants"][window_number]
-                * unit.kilocalories_per_mole
-                / unit.radian ** 2
-            )
+    if angles:
+        angle_restraint = openmm.CustomAngleForce("k * (theta - theta_0)^2")
+        angle_restraint.addPerAngleParameter("k")
+        angle_restraint.addPerAngleParameter("theta_0")
+
+        for restraint in angles:
+            target, force_constant = _get_window_values(restraint, phase, window_number)
+            theta_0 = target * _DEGREE
+            k = force_constant * _KCAL_PER_MOL_PER_RAD2
             angle_restraint.addAngle(
                 restraint.index1[0],
                 restraint.index2[0],
                 restraint.index3[0],
                 [k, theta_0],
             )
-            system.addForce(angle_restraint)
-        else:
-            # Probably needs openmm.CustomCentroidAngleForce (?)
-            raise NotImplementedError
-        if force_group:
-            angle_restraint.setForceGroup(force_group)
-
-    elif restraint.mask4:
-        if (
-            not restraint.group1
-            and not restraint.group2
-            and not restraint.group3
-            and not restraint.group4
-        ):
-            dihedral_restraint = openmm.CustomTorsionForce(
-                f"k * min(min(abs(theta - theta_0), abs(theta - theta_0 + 2 * "
-                f"{_PI_})), abs(theta - theta_0 - 2 * {_PI_}))^2"
-            )
-            dihedral_restraint.addPerTorsionParameter("k")
-            dihedral_restraint.addPerTorsionParameter("theta_0")
-
-            theta_0 = restraint.phase[phase]["targets"][window_number] * unit.degrees
-            k = (
-                restraint.phase[phase]["force_constants"][window_number]
-                * unit.kilocalories_per_mole
-                / unit.radian ** 2
-            )
+        forces.append(angle_restraint)
+
+    if torsions:
+        # Wrap the displacement into [-pi, pi) so the harmonic restraint is periodic.
+        dihedral_restraint = openmm.CustomTorsionForce(
+            f"k * dtheta^2; "
+            f"dtheta = theta - theta_0 - two_pi * floor((theta - theta_0 + {_PI_}) / two_pi); "
+            f"two_pi = {2 * _PI_}"
+        )
+        dihedral_restraint.addPerTorsionParameter("k")
+        dihedral_restraint.addPerTorsionParameter("theta_0")
+
+        for restraint in torsions:
+            target, force_constant = _get_window_values(restraint, phase, window_number)
+            theta_0 = target * _DEGREE
+            k = force_constant * _KCAL_PER_MOL_PER_RAD2
             dihedral_restraint.addTorsion(
                 restraint.index1[0],
                 restraint.index2[0],
@@ -225,9 +300,19 @@ def apply_dat_restraint(
                 restraint.index4[0],
                 [k, theta_0],
             )
-            system.addForce(dihedral_restraint)
-        else:
-            # Probably needs openmm.CustomCentroidTorsionForce (?)
-            raise NotImplementedError
+        forces.append(dihedral_restraint)
+
+    for force in forces:
+        system.addForce(force)
         if force_group:
-            dihedral_restraint.setForceGroup(force_group)
+            force.setForceGroup(force_group)
+
+
+def _get_window_values(restraint, phase, window_number):
+    """Return the target and force constant of a restraint for a given window."""
+    phase_values = restraint.phase[phase]
+
+    return (
+        phase_values["targets"][window_number],
+        phase_values["force_constants"][window_number],
+    )
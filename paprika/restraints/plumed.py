@@ -1,17 +1,24 @@
+import itertools
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from parmed.structure import Structure as ParmedStructureClass
 
 from paprika.build.dummy import extract_dummy_atoms
 from paprika.restraints.utils import get_bias_potential_type, parse_window
-from paprika.utils import get_key, return_parmed_structure
+from paprika.utils import return_parmed_structure
 
 logger = logging.getLogger(__name__)
 
 _PI_ = np.pi
 
+# Units supported by Plumed that can be used for the restraints
+_ENERGY_UNITS = frozenset({"kj/mol", "kcal/mol"})
+_LENGTH_UNITS = frozenset({"nm", "A"})
+_TIME_UNITS = frozenset({"ps", "fs", "ns"})
+
 
 class Plumed:
     """
@@ -169,8 +176,7 @@ class Plumed:
         self.k_factor = 1.0
         self._units = None
         self.header_line = None
-        self.group_index = None
-        self.group_atoms = None
+        self._file_paths = None
 
     def _initialize(self):
         # Set factor for spring constant
@@ -190,6 +196,12 @@ class Plumed:
             f"TIME={self.units['time']}"
         )
 
+        # Restraint file for each window
+        self._file_paths = {
+            window: os.path.join(self.path, window, self.file_name)
+            for window in self.window_list
+        }
+
     def dump_to_file(self):
         """
         Write the `Plumed`-style restraints to file.
@@ -197,92 +209,137 @@ class Plumed:
 
         self._initialize()
 
-        # Loop over APR windows
-        for windows in self.window_list:
-
-            window, phase = parse_window(windows)
-
-            # Check if file exist and write header line
-            with open(os.path.join(self.path, windows, self.file_name), "w") as file:
-                file.write(self.header_line + "\n")
-
-            cv_index = 1
-            cv_dict = {}
-            cv_lines = []
-            bias_lines = []
-
-            self.group_index = 1
-            self.group_atoms = {}
-
-            # Parse each restraint in the list
-            for restraint in self.restraint_list:
-                # Skip restraint if the target or force constant is not defined.
-                # Example: wall restraints only used during the attach phase.
-                try:
-                    target = restraint.phase[phase]["targets"][window]
-                    force_constant = (
-                        restraint.phase[phase]["force_constants"][window]
-                        * self.k_factor
-                    )
-                except TypeError:
-                    continue
-
-                # Convert list to comma-separated string
-                atom_index = self._get_atom_indices(restraint)
-                atom_string = ",".join(map(str, atom_index))
-
-                # Determine collective variable type
-                colvar_type = "distance"
-                if len(atom_index) == 3:
-                    colvar_type = "angle"
-                    target *= _PI_ / 180.0
-                elif len(atom_index) == 4:
-                    colvar_type = "torsion"
-                    target *= _PI_ / 180.0
-
-                # Determine bias type for this restraint
+        # Parse the restraints once, only the targets, force constants and the
+        # labels of the centroid groups change between windows.
+        parsed_restraints = []
+        for restraint in self.restraint_list:
+            atom_index = self._get_atom_indices(restraint)
+
+            # Determine collective variable type
+            colvar_type = "distance"
+            angle_scale = 1.0
+            if len(atom_index) == 3:
+                colvar_type = "angle"
+                angle_scale = _PI_ / 180.0
+            elif len(atom_index) == 4:
+                colvar_type = "torsion"
+                angle_scale = _PI_ / 180.0
+
+            # Without custom Amber-style values the targets and force constants on
+            # both sides are equal, so the bias is a harmonic restraint in every
+            # window. Otherwise it is determined for each window below.
+            bias_type = "restraint"
+            if any(
+                restraint.custom_restraint_values.get(key) is not None
+                for key in ["r2", "r3", "rk2", "rk3"]
+            ):
+                bias_type = None
+
+            parsed_restraints.append(
+                (restraint, atom_index, colvar_type, angle_scale, bias_type)
+            )
+
+        # Loop over APR windows, the windows are independent of each other so the
+        # files are written concurrently.
+        with ThreadPoolExecutor() as executor:
+            list(
+                executor.map(
+                    self._write_window,
+                    self.window_list,
+                    itertools.repeat(parsed_restraints),
+                )
+            )
+
+    def _write_window(self, windows, parsed_restraints):
+        window, phase = parse_window(windows)
+
+        cv_index = 1
+        cv_keys = {}
+        cv_lines = []
+        bias_lines = []
+
+        # Centroid group definitions, keyed by label and by atom string
+        group_atoms = {}
+        group_keys = {}
+
+        # Parse each restraint in the list
+        for (
+            restraint,
+            atom_index,
+            colvar_type,
+            angle_scale,
+            bias_type,
+        ) in parsed_restraints:
+            # Skip restraint if the target or force constant is not defined.
+            # Example: wall restraints only used during the attach phase.
+            phase_values = restraint.phase.get(phase)
+            if phase_values is None:
+                continue
+
+            targets = phase_values.get("targets")
+            force_constants = phase_values.get("force_constants")
+            if targets is None or force_constants is None:
+                continue
+
+            target = targets[window] * angle_scale
+            force_constant = force_constants[window] * self.k_factor
+
+            # Convert list to comma-separated string, centroid groups are
+            # labelled in the order they appear in this window.
+            atom_string = ",".join(
+                self._get_group_key(group_atoms, group_keys, index)
+                if isinstance(index, str)
+                else str(index)
+                for index in atom_index
+            )
+
+            # Determine bias type for this restraint
+            if bias_type is None:
                 bias_type = get_bias_potential_type(restraint, phase, window)
 
-                # Append cv strings to lists
-                # The code below prevents duplicate cv definition.
-                # While not necessary, it makes the plumed file cleaner.
-                if not get_key(cv_dict, atom_string):
-                    cv_key = f"c{cv_index}"
-                    cv_dict[cv_key] = atom_string
-
-                    cv_lines.append(
-                        f"{cv_key}: {colvar_type.upper()} ATOMS={atom_string} NOPBC\n"
-                    )
-                    bias_lines.append(
-                        f"{bias_type.upper()} ARG={cv_key} AT={target:.4f} KAPPA={force_constant:.2f}\n"
-                    )
-                else:
-                    cv_key = get_key(cv_dict, atom_string)[0]
-
-                    bias_lines.append(
-                        f"{bias_type.upper()} ARG={cv_key} AT={target:.4f} KAPPA={force_constant:.2f}\n"
-                    )
-
-                # Increment cv index
-                cv_index += 1
-
-            # Write collective variables to file
-            self._write_colvar_to_file(windows, cv_lines, bias_lines)
-
-    def _write_colvar_to_file(self, window, cv_list, bias_list):
-        with open(os.path.join(self.path, window, self.file_name), "a") as file:
-            if len(self.group_atoms) != 0:
-                file.write("# Centroid groups\n")
-                for key, value in self.group_atoms.items():
-                    file.write(f"{key}: COM ATOMS={value}\n")
-
-            file.write("# Collective variables\n")
-            for line in cv_list:
-                file.write(line)
-
-            file.write("# Bias potentials\n")
-            for line in bias_list:
-                file.write(line)
+            # Append cv strings to lists
+            # The code below prevents duplicate cv definition.
+            # While not necessary, it makes the plumed file cleaner.
+            cv_key = cv_keys.get(atom_string)
+            if cv_key is None:
+                cv_key = f"c{cv_index}"
+                cv_keys[atom_string] = cv_key
+
+                cv_lines.append(
+                    f"{cv_key}: {colvar_type.upper()} ATOMS={atom_string} NOPBC\n"
+                )
+
+            bias_lines.append(
+                f"{bias_type.upper()} ARG={cv_key} AT={target:.4f} KAPPA={force_constant:.2f}\n"
+            )
+
+            # Increment cv index
+            cv_index += 1
+
+        # Write collective variables to file
+        self._write_colvar_to_file(windows, group_atoms, cv_lines, bias_lines)
+
+    def _write_colvar_to_file(self, window, group_atoms, cv_list, bias_list):
+        group_lines = []
+        if len(group_atoms) != 0:
+            group_lines.append("# Centroid groups\n")
+            group_lines += [
+                f"{key}: COM ATOMS={value}\n" for key, value in group_atoms.items()
+            ]
+
+        body = "".join(
+            itertools.chain(
+                [self.header_line + "\n"],
+                group_lines,
+                ["# Collective variables\n"],
+                cv_list,
+                ["# Bias potentials\n"],
+                bias_list,
+            )
+        )
+
+        with open(self._file_paths[window], "w") as file:
+            file.write(body)
 
     def _get_atom_indices(self, restraint):
         # Check atom index setting
@@ -291,62 +348,54 @@ class Plumed:
             index_shift = 1
             logger.debug("Atom indices starts from 0 --> shifting indices by 1.")
 
-        # Collect DAT atom indices
+        # Collect DAT atom indices, centroid groups are stored as the
+        # comma-separated string of their atom indices.
         atom_index = []
 
         if not restraint.group1:
             atom_index.append(restraint.index1[0] + index_shift)
         else:
-            igr1 = ""
-            for index in restraint.index1:
-                igr1 += "{},".format(index + index_shift)
-
-            if not get_key(self.group_atoms, igr1):
-                self.group_atoms[f"g{self.group_index}"] = igr1
-                self.group_index += 1
-
-            atom_index.append(get_key(self.group_atoms, igr1)[0])
+            igr1 = (
+                ",".join(str(index + index_shift) for index in restraint.index1) + ","
+            )
+            atom_index.append(igr1)
 
         if not restraint.group2:
             atom_index.append(restraint.index2[0] + index_shift)
         else:
-            igr2 = ""
-            for index in restraint.index2:
-                igr2 += "{},".format(index + index_shift)
-
-            if not get_key(self.group_atoms, igr2):
-                self.group_atoms[f"g{self.group_index}"] = igr2
-                self.group_index += 1
-
-            atom_index.append(get_key(self.group_atoms, igr2)[0])
+            igr2 = (
+                ",".join(str(index + index_shift) for index in restraint.index2) + ","
+            )
+            atom_index.append(igr2)
 
         if restraint.index3 and not restraint.group3:
             atom_index.append(restraint.index3[0] + index_shift)
         elif restraint.group3:
-            igr3 = ""
-            for index in restraint.index3:
-                igr3 += "{},".format(index + index_shift)
-
-            if not get_key(self.group_atoms, igr3):
-                self.group_atoms[f"g{self.group_index}"] = igr3
-                self.group_index += 1
-
-            atom_index.append(get_key(self.group_atoms, igr3)[0])
+            igr3 = (
+                ",".join(str(index + index_shift) for index in restraint.index3) + ","
+            )
+            atom_index.append(igr3)
 
         if restraint.index4 and not restraint.group4:
             atom_index.append(restraint.index4[0] + index_shift)
         elif restraint.group4:
-            igr4 = ""
-            for index in restraint.index4:
-                igr4 += "{},".format(index + index_shift)
+            igr4 = (
+                ",".join(str(index + index_shift) for index in restraint.index4) + ","
+            )
+            atom_index.append(igr4)
 
-            if not get_key(self.group_atoms, igr4):
-                self.group_atoms[f"g{self.group_index}"] = igr4
-                self.group_index += 1
+        return atom_index
 
-            atom_index.append(get_key(self.group_atoms, igr4)[0])
+    @staticmethod
+    def _get_group_key(group_atoms, group_keys, atom_string):
+        # Look up the centroid group for this set of atoms (or define a new one)
+        group_key = group_keys.get(atom_string)
+        if group_key is None:
+            group_key = f"g{len(group_atoms) + 1}"
+            group_keys[atom_string] = group_key
+            group_atoms[group_key] = atom_string
 
-        return atom_index
+        return group_key
 
     def add_dummy_atom_restraints(self, structure, window, path=None):
         """
@@ -418,56 +467,43 @@ class Plumed:
 
         """
 
-        file.write("# Dummy Atoms\n")
-        file.write(f"dm1: POSITION ATOM={dummy_atoms['DM1']['idx']} NOPBC\n")
-        file.write(f"dm2: POSITION ATOM={dummy_atoms['DM2']['idx']} NOPBC\n")
-        file.write(f"dm3: POSITION ATOM={dummy_atoms['DM3']['idx']} NOPBC\n")
+        dummy_names = ["DM1", "DM2", "DM3"]
+        positions = np.array([dummy_atoms[name]["pos"] for name in dummy_names]).ravel()
 
         arg = "dm1.x,dm1.y,dm1.z," "dm2.x,dm2.y,dm2.z," "dm3.x,dm3.y,dm3.z,"
-
-        at = (
-            f"{dummy_atoms['DM1']['pos'][0]:0.3f},"
-            f"{dummy_atoms['DM1']['pos'][1]:0.3f},"
-            f"{dummy_atoms['DM1']['pos'][2]:0.3f},"
-        )
-        at += (
-            f"{dummy_atoms['DM2']['pos'][0]:0.3f},"
-            f"{dummy_atoms['DM2']['pos'][1]:0.3f},"
-            f"{dummy_atoms['DM2']['pos'][2]:0.3f},"
-        )
-        at += (
-            f"{dummy_atoms['DM3']['pos'][0]:0.3f},"
-            f"{dummy_atoms['DM3']['pos'][1]:0.3f},"
-            f"{dummy_atoms['DM3']['pos'][2]:0.3f},"
-        )
-
-        kappa = (
-            f"{kpos:0.1f},{kpos:0.1f},{kpos:0.1f},"
-            f"{kpos:0.1f},{kpos:0.1f},{kpos:0.1f},"
-            f"{kpos:0.1f},{kpos:0.1f},{kpos:0.1f},"
-        )
-
-        file.write("RESTRAINT ...\n")
-        file.write(f"ARG={arg}\n")
-        file.write(f"AT={at}\n")
-        file.write(f"KAPPA={kappa}\n")
-        file.write("LABEL=dummy\n")
-        file.write("... RESTRAINT\n")
+        at = ",".join(f"{value:0.3f}" for value in positions) + ","
+        kappa = ",".join([f"{kpos:0.1f}"] * len(positions)) + ","
+
+        lines = ["# Dummy Atoms"]
+        lines += [
+            f"{name.lower()}: POSITION ATOM={dummy_atoms[name]['idx']} NOPBC"
+            for name in dummy_names
+        ]
+        lines += [
+            "RESTRAINT ...",
+            f"ARG={arg}",
+            f"AT={at}",
+            f"KAPPA={kappa}",
+            "LABEL=dummy",
+            "... RESTRAINT",
+        ]
+
+        file.write("\n".join(lines) + "\n")
 
 
 def _check_plumed_units(units):
     """
     Checks the specified units and makes sure that its supported.
     """
-    if units["energy"] not in ["kj/mol", "kcal/mol"]:
+    if units["energy"] not in _ENERGY_UNITS:
         raise Exception(
             f"Specified unit for energy ({units['energy']}) is not supported."
         )
 
-    if units["length"] not in ["nm", "A"]:
+    if units["length"] not in _LENGTH_UNITS:
         raise Exception(
             f"Specified unit for length ({units['length']}) is not supported."
         )
 
-    if units["time"] not in ["ps", "fs", "ns"]:
+    if units["time"] not in _TIME_UNITS:
         raise Exception(f"Specified unit for time ({units['time']}) is not supported.")
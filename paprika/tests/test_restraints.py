@@ -15,6 +15,7 @@ from paprika.restraints.utils import (
     get_bias_potential_type,
     get_restraint_values,
 )
+from paprika.tests import addons
 
 logger = logging.getLogger(__name__)
 
@@ -990,3 +991,74 @@ def test_extract_guest_restraints():
     assert guest_restraints[3] is not None
     assert guest_restraints[4] is not None
     assert guest_restraints[5] is not None
+
+
+@addons.using_openmm
+def test_apply_dat_restraints():
+    """Test that restraints of the same type share a single OpenMM force."""
+    from simtk import openmm, unit
+
+    from paprika.restraints.openmm import apply_dat_restraint, apply_dat_restraints
+
+    topology = os.path.join(
+        os.path.dirname(__file__), "../data/cb6-but/cb6-but-dum.pdb"
+    )
+    masks = [
+        [":DM1", ":BUT@C3"],
+        [":DM1", ":CB6@O,O2,O4,O6,O8,O10"],
+        [":DM2", ":DM1", ":BUT@C3"],
+        [":DM1", ":BUT@C3", ":BUT@C"],
+        [":DM3", ":DM2", ":DM1", ":BUT@C3"],
+    ]
+    targets = [6.0, 4.0, 180.0, 180.0, 120.0]
+
+    restraints = []
+    for mask, target in zip(masks, targets):
+        r = DAT_restraint()
+        r.amber_index = False
+        r.continuous_apr = True
+        r.auto_apr = False
+        r.topology = topology
+        r.mask1, r.mask2 = mask[:2]
+        if len(mask) > 2:
+            r.mask3 = mask[2]
+        if len(mask) > 3:
+            r.mask4 = mask[3]
+        r.attach["target"] = target
+        r.attach["num_windows"] = 3
+        r.attach["fc_initial"] = 0.0
+        r.attach["fc_final"] = 10.0
+        r.initialize()
+        restraints.append(r)
+
+    structure = pmd.load_file(topology, structure=True)
+    positions = structure.coordinates * 0.1 + np.random.normal(
+        0.0, 0.05, size=(len(structure.atoms), 3)
+    )
+
+    def compute_energy(system):
+        context = openmm.Context(
+            system,
+            openmm.VerletIntegrator(0.001),
+            openmm.Platform.getPlatformByName("Reference"),
+        )
+        context.setPositions(positions)
+        energy = context.getState(getEnergy=True).getPotentialEnergy()
+        return energy.value_in_unit(unit.kilojoules_per_mole)
+
+    batched_system = openmm.System()
+    single_system = openmm.System()
+    for _ in structure.atoms:
+        batched_system.addParticle(1.0)
+        single_system.addParticle(1.0)
+
+    apply_dat_restraints(batched_system, restraints, "attach", 2, force_group=5)
+    for restraint in restraints:
+        apply_dat_restraint(single_system, restraint, "attach", 2, force_group=5)
+
+    # One force each for bonds, centroid bonds, angles and torsions.
+    assert batched_system.getNumForces() == 4
+    assert single_system.getNumForces() == len(restraints)
+    assert all(force.getForceGroup() == 5 for force in batched_system.getForces())
+    assert compute_energy(batched_system) > 0.0
+    assert np.isclose(compute_energy(batched_system), compute_energy(single_system))